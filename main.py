@@ -15,28 +15,87 @@
 # [START functions_cloudevent_ocr]
 import base64
 import json
+import math
 import os
-import cv2
-import numpy as np
-from tempfile import NamedTemporaryFile
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
 from cloudevents.http import CloudEvent
 
 import functions_framework
 
-from google.cloud import pubsub_v1
 from google.cloud import storage
-from google.cloud import translate_v2 as translate
-from google.cloud import vision
 
 
-vision_client = vision.ImageAnnotatorClient()
-translate_client = translate.Client()
-publisher = pubsub_v1.PublisherClient()
+# Both functions deploy from this file, so the clients and heavy imports only
+# process_image needs are created on first use instead of at cold start
+vision_client = None
+publisher = None
 storage_client = storage.Client()
 
 project_id = os.environ.get("GCP_PROJECT")
 
+# Every image is resized to this dimension before cropping
+_TARGET_W, _TARGET_H = 1584, 1224
+_TARGET_RATIO = _TARGET_W / _TARGET_H
+
+# Sections of the resized image to crop, format: name,x,y,h,w
+_ROIS: tuple[tuple[str, int, int, int, int], ...] = (
+    ("renew_size", 171, 405, 57, 111),
+    ("nearest_crossed_street", 355, 125, 52, 351),
+    ("house_number", 1050, 200, 125, 200),
+    ("renew_date", 111, 504, 43, 225),
+)
+
+# OCR values that are commonly misread for the accepted renew sizes
+_RENEW_SIZE_MAP = {"162": "1/2", "364": "3/4"}
+_RENEW_SIZE_ACCEPT = frozenset({"1/2", "3/4", "1"})
+_NL_RE = re.compile(r"\n+")
+
+# A crop with fewer dark pixels than this ratio is considered blank
+_INK_LEVEL = 128
+_MIN_INK_RATIO = 0.005
+
+# Number of bytes fetched to read the image dimensions before the full download
+_HEADER_BYTES = 64 * 1024
+
+# Bucket handles reused across warm invocations
+_BUCKET_CACHE = {}
+
+def get_bucket(name: str):
+    """
+    Returns a cached handle to the bucket. No API request is made since only
+    blobs are accessed, not the bucket metadata.
+    """
+    if name not in _BUCKET_CACHE:
+        _BUCKET_CACHE[name] = storage_client.bucket(name)
+    return _BUCKET_CACHE[name]
+
+def get_vision_client():
+    """
+    Returns the Vision client, creating it on the first call.
+    """
+    global vision_client
+    if vision_client is None:
+        from google.cloud import vision
+        vision_client = vision.ImageAnnotatorClient()
+    return vision_client
+
+def get_publisher():
+    """
+    Returns the Pub/Sub publisher client, creating it on the first call.
+    """
+    global publisher
+    if publisher is None:
+        from google.cloud import pubsub_v1
+        # Each invocation publishes a single message, so send it right away
+        # instead of waiting for the batch to fill up
+        publisher = pubsub_v1.PublisherClient(
+            batch_settings=pubsub_v1.types.BatchSettings(max_messages=1, max_latency=0.01)
+        )
+    return publisher
+
 @functions_framework.cloud_event
 def process_image(cloud_event: CloudEvent) -> None:
     """ Edits the image to prepare for text extractions
@@ -60,13 +119,21 @@ def process_image(cloud_event: CloudEvent) -> None:
     file_name = data["name"]
     print("file name ", file_name)
     image = resize_image(bucket, file_name)
-    dest_bucket_name, cropped_file_names = get_cropped_sections(image, file_name)
-    detect_text(dest_bucket_name, cropped_file_names, file_name)
+    cropped_images = get_cropped_sections(image)
+    # Keep a copy of the cropped images in the cloud for reference, uploading
+    # them in the background while the text is detected and published
+    with ThreadPoolExecutor(max_workers=len(cropped_images)) as executor:
+        upload_futures = save_cropped_sections(executor, cropped_images, file_name)
+        detect_text(cropped_images, file_name)
+        for upload_future in upload_futures:
+            upload_future.result()
+    print(f"Files {[name for name, _, _ in cropped_images]} saved to {os.environ['PROCESSED_BUCKET']} bucket")
     print(f"File {file_name} processed.")
             
 def resize_image(bucket: str, file_name: str):
     """
-        Resizes input image to the dimension of 1584x1224 and saves result to cloud
+        Resizes input image to the dimension of 1584x1224 and saves result to cloud.
+        Images that already have that dimension are returned unchanged.
     Args:
         bucket (str): Google Cloud bucket where the image file is located
         file_name (str): Name of the image file
@@ -75,116 +142,177 @@ def resize_image(bucket: str, file_name: str):
     Returns:
         A Resized ndarray Image 
     """
-    source_bucket = storage_client.get_bucket(bucket)
+    import cv2
+    import numpy as np
+    from PIL import Image, UnidentifiedImageError
+
+    source_bucket = get_bucket(bucket)
     source_blob = source_bucket.get_blob(file_name)
-    image = np.asarray(bytearray(source_blob.download_as_string()), dtype="uint8")
-    image = cv2.imdecode(image, cv2.IMREAD_UNCHANGED)
-    height, width, _ = image.shape
-    ratio = round(width / height, 3)
-    if ratio != 1.294:
-        raise ValueError(f"Width to Height ratio is not equal to 1.294, width: {width} height: {height} width/height: {ratio}")
-    if width > 1584 and height > 1224:
-        image = cv2.resize(image, (1584, 1224), interpolation=cv2.INTER_AREA)
-    elif width < 1584 and height < 1224:
-        image = cv2.resize(image, (1584, 1224), interpolation=cv2.INTER_LINEAR)
-    # Creates the resized file and saves to cloud
-    with NamedTemporaryFile() as temp:
-        temp_file = "".join([str(temp.name), "og_image.jpg"])
-        cv2.imwrite(temp_file, image)
-        temp_blob = source_bucket.blob(file_name)
-        temp_blob.upload_from_filename(temp_file)
+    # Read the dimensions from the start of the file so the ratio is checked before the full download
+    header_bytes = source_blob.download_as_bytes(end=_HEADER_BYTES - 1)
+    image_bytes = header_bytes if source_blob.size <= len(header_bytes) else None
+    try:
+        with Image.open(BytesIO(header_bytes)) as header_image:
+            width, height = header_image.size
+    except (UnidentifiedImageError, OSError):
+        # The header ends past the first bytes, e.g. inside a large EXIF, XMP or ICC segment
+        if image_bytes is None:
+            image_bytes = header_bytes + source_blob.download_as_bytes(start=len(header_bytes))
+        with Image.open(BytesIO(image_bytes)) as header_image:
+            width, height = header_image.size
+    ratio = width / height
+    if not math.isclose(ratio, _TARGET_RATIO, abs_tol=5e-4):
+        raise ValueError(f"Width to Height ratio is not equal to {_TARGET_RATIO:.3f}, width: {width} height: {height} width/height: {ratio:.3f}")
+    if image_bytes is None:
+        image_bytes = header_bytes + source_blob.download_as_bytes(start=len(header_bytes))
+    with Image.open(BytesIO(image_bytes)) as source_image:
+        if source_image.format == "JPEG" and width >= 2 * _TARGET_W and height >= 2 * _TARGET_H:
+            # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding
+            source_image.draft("RGB", (_TARGET_W, _TARGET_H))
+            image = cv2.cvtColor(np.asarray(source_image.convert("RGB")), cv2.COLOR_RGB2BGR)
+        else:
+            image = cv2.imdecode(
+                np.frombuffer(image_bytes, dtype=np.uint8),
+                cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+            )
+    # Images already at the target size are neither resized nor uploaded again
+    if (width, height) == (_TARGET_W, _TARGET_H):
+        return image
+    # A draft decode may already be at the target size, otherwise INTER_AREA is
+    # used whether the image is scaled up or down
+    decoded_height, decoded_width, _ = image.shape
+    if (decoded_width, decoded_height) != (_TARGET_W, _TARGET_H):
+        image = cv2.resize(image, (_TARGET_W, _TARGET_H), interpolation=cv2.INTER_AREA)
+    # Encodes the resized image in memory and saves to cloud
+    _, image_buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    resized_blob = source_bucket.blob(file_name)
+    resized_blob.upload_from_string(image_buffer.tobytes(), content_type="image/jpeg")
     return image
 
-def get_cropped_sections(image, file_name):
+def get_cropped_sections(image):
     """
-    Saves cropped images that displays the desired values to the cloud.
+    Crops the sections that display the desired values.
 
     Args:
         image (ndarray): input image that needs to be cropped
-        file_name (string): Name of the image file
     Returns:
-        string: bucket where cropped images will be stored
-        list[string]: list of cropped images names
-    """
-    # dimensions to crop images to, format: x,y,h,w
-    cropped_dims = [(171, 405, 57, 111), (355, 125, 52, 351), (1050, 200, 125, 200), (111, 504, 43, 225)]
-    cropped_file_names = ["renew_size", "nearest_crossed_street", "house_number", "renew_date"]
-    dest_bucket_name = os.environ['PROCESSED_BUCKET']
-    dest_bucket = storage_client.get_bucket(dest_bucket_name)
-    for index in range(len(cropped_dims)):
-        cropped_dim = cropped_dims[index]
-        cropped_file_name = cropped_file_names[index] + "_" + file_name
-        x,y,h,w = cropped_dim
+        list[tuple[str, bytes, bool]]: name, JPEG encoded bytes and blank flag of each cropped image
+    """
+    import cv2
+
+    cropped_images = []
+    for name, x, y, h, w in _ROIS:
+        # OpenCV reads the slice view in place, so the crop is never copied
         crop_image = image[y:y + h, x:x + w]
-        with NamedTemporaryFile() as temp:
-            temp_file = "".join([str(temp.name), cropped_file_name])
-            cv2.imwrite(temp_file, crop_image)
-            dest_blob = dest_bucket.blob(cropped_file_name)
-            dest_blob.upload_from_filename(temp_file)
-            print(f"File {cropped_file_names[index]} saved to {dest_bucket_name} bucket")
-    return dest_bucket_name, cropped_file_names
+        # The crops are only used for OCR, so a lower quality is enough
+        _, crop_buffer = cv2.imencode(".jpg", crop_image, [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+        gray_crop = cv2.cvtColor(crop_image, cv2.COLOR_BGR2GRAY)
+        is_blank = (gray_crop < _INK_LEVEL).mean() < _MIN_INK_RATIO
+        cropped_images.append((name, crop_buffer.tobytes(), is_blank))
+    return cropped_images
+
+def save_cropped_sections(executor: ThreadPoolExecutor, cropped_images: list[tuple[str, bytes, bool]], file_name: str):
+    """
+    Starts saving the cropped images to the cloud, one upload per executor thread.
+
+    Args:
+        executor (ThreadPoolExecutor): executor that runs the uploads
+        cropped_images (list[tuple[str, bytes, bool]]): name, JPEG encoded bytes and blank flag of each cropped image
+        file_name (str): Name of the image file
+    Returns:
+        list[Future]: futures of the running uploads
+    """
+    dest_bucket = get_bucket(os.environ['PROCESSED_BUCKET'])
+    return [
+        executor.submit(
+            dest_bucket.blob(f"{name}_{file_name}").upload_from_string,
+            crop_bytes,
+            content_type="image/jpeg",
+        )
+        for name, crop_bytes, _ in cropped_images
+    ]
     
 
-def detect_text(bucket: str, cropped_file_names: list[str], file_name: str) -> None:
+def _clean_renew_size(text: str) -> str:
+    """
+    Returns the renew size if it is one of the accepted values, otherwise an empty string.
+    """
+    text = text.replace("\"","")
+    text = _RENEW_SIZE_MAP.get(text, text)
+    return text if text in _RENEW_SIZE_ACCEPT else ""
+
+def _clean_nearest_crossed_street(text: str) -> str:
+    """
+    Returns the text between the first and second period, if any.
     """
-    Detect text in all the cropped images and reformat text output to match format
+    text = _NL_RE.sub(" ", text)
+    _, period, after_period = text.partition(".")
+    return after_period.partition(".")[0] if period else text
+
+def _clean_last_word(text: str) -> str:
+    """
+    Returns the last word of the text.
+    """
+    return _NL_RE.sub(" ", text).rpartition(" ")[2]
+
+# Reformats the OCR text of each cropped image to match format
+_TEXT_HANDLERS = {
+    "renew_size": _clean_renew_size,
+    "nearest_crossed_street": _clean_nearest_crossed_street,
+    "house_number": _clean_last_word,
+    "renew_date": _clean_last_word,
+}
+
+def detect_text(cropped_images: list[tuple[str, bytes, bool]], file_name: str) -> None:
+    """
+    Detect text in all the cropped images and reformat text output to match format.
+    Blank cropped images are not sent to the Vision API.
 
     Args:
-        bucket (str): bucket name where the cropped images are stored
-        cropped_file_names (list[str]): list of cropped images names
+        cropped_images (list[tuple[str, bytes, bool]]): name, JPEG encoded bytes and blank flag of each cropped image
         file_name (str): input image file name 
     """
+    from google.cloud import vision
+
     print(f"Looking for text in image {file_name}")
 
-    # Use the Vision API to extract text from the image
+    # Use the Vision API to extract text from all the non blank cropped images in one request
+    ocr_images = [(name, crop_bytes) for name, crop_bytes, is_blank in cropped_images if not is_blank]
+    annotations_map = {}
+    if ocr_images:
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=crop_bytes),
+                features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+            )
+            for _, crop_bytes in ocr_images
+        ]
+        batch_response = get_vision_client().batch_annotate_images(requests=requests)
+        for (name, _), response in zip(ocr_images, batch_response.responses):
+            annotations_map[name] = response.text_annotations
     utility_map = {}
     original_map = {}
-    for cropped_file_name in cropped_file_names:
-        cropped_file_name_cloud = cropped_file_name + "_" + file_name
-        # Get Text from cropped images
-        image = vision.Image(
-            source=vision.ImageSource(gcs_image_uri=f"gs://{bucket}/{cropped_file_name_cloud}")
-        )
-        text_detection_response = vision_client.text_detection(image=image)
-        annotations = text_detection_response.text_annotations
+    for cropped_file_name, _, _ in cropped_images:
+        annotations = annotations_map.get(cropped_file_name)
         # Reformat Text output
         if annotations:
             text = annotations[0].description
             original_map[cropped_file_name] = text
-            if cropped_file_name == "renew_size":
-                text = text.replace("\"","")
-                accept_set = {"1/2", "3/4", "1"}
-                if text == "162":
-                    text = "1/2"
-                elif text == "364":
-                    text = "3/4"
-                if text not in accept_set:
-                    text = ""
-            elif cropped_file_name == "nearest_crossed_street":
-                text = text.replace("\n"," ")
-                if text.find(".") >= 0 and len(text.split(".")) > 1:
-                    text = text.split(".")[1]
-            elif cropped_file_name == "house_number":
-                text = text.replace("\n"," ")
-                text = text.split(" ")[-1]
-            elif cropped_file_name == "renew_date":
-                text = text.replace("\n"," ")
-                text = text.split(" ")[-1]    
+            text = _TEXT_HANDLERS[cropped_file_name](text)
         else:
             text = ""    
         print(f"{cropped_file_name} text value: ", text)
         utility_map[cropped_file_name] = text
     utility_map["original_translation"] = original_map
-    # Sending message to cloud service that saves data
-    message = {
-            "utility_map": utility_map,
-            "filename": file_name
-        }
-    message_data = json.dumps(message).encode("utf-8")
+    # Sending message to cloud service that saves data, the data is already
+    # formatted as the saved json file and the file name is sent as an attribute
+    message_data = json.dumps(utility_map, indent=4).encode("utf-8")
     result_name = os.environ.get("RESULT_NAME")
-    result_path = publisher.topic_path(project_id, result_name)
-    future = publisher.publish(result_path, data=message_data)
-    future.result()
+    publisher_client = get_publisher()
+    result_path = publisher_client.topic_path(project_id, result_name)
+    future = publisher_client.publish(result_path, data=message_data, filename=file_name)
+    # Wait for the publish to finish, the function may be throttled once it returns
+    future.result(timeout=30)
 
 @functions_framework.cloud_event
 def save_result(cloud_event: CloudEvent) -> None:
@@ -205,31 +333,30 @@ def save_result(cloud_event: CloudEvent) -> None:
     if received_type != expected_type:
         raise ValueError(f"Expected {expected_type} but received {received_type}")
 
-    # Extract the message body, expected to be a JSON representation of a
-    # dictionary, and extract the fields from that dictionary.
-    data = cloud_event.data["message"]["data"]
+    # Extract the message body, expected to be the JSON file content, and the
+    # file name from the message attributes. The body is saved as is.
+    message = cloud_event.data["message"]
+    data = message["data"]
     try:
-        message_data = base64.b64decode(data)
-        message = json.loads(message_data)
-        utility_map = message["utility_map"]
-        filename = message["filename"]
+        utility_json = base64.b64decode(data).decode("utf-8")
+        filename = (message.get("attributes") or {}).get("filename")
+        if filename is None:
+            # Messages published before the file name moved to the attributes
+            # hold a dictionary with both the utility map and the file name
+            old_message = json.loads(utility_json)
+            utility_json = json.dumps(old_message["utility_map"], indent=4)
+            filename = old_message["filename"]
         print(f"filename {filename}")
     except Exception as e:
         raise ValueError(f"Missing or malformed PubSub message {data}: {e}.")
 
     print(f"Received request to save file {filename}.")
     
-    utility_json = json.dumps(utility_map, indent=4)
-    
-    # Save extracted text to a json file
-    with open("content.json", "w") as outfile:
-        outfile.write(utility_json)
-
     bucket_name = os.environ["RESULT_BUCKET"]
     filename_no_ext = filename.split(".")[0]
     result_filename = f"{filename_no_ext}.json"
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = get_bucket(bucket_name)
     blob = bucket.blob(result_filename)
     print(f"Saving result to {result_filename} in bucket {bucket_name}.")
-    blob.upload_from_filename("content.json")
+    blob.upload_from_string(utility_json, content_type="application/json")
     print("File saved.")
\ No newline at end of file